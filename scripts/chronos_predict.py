@@ -1,56 +1,253 @@
 import sys
 import json
-import torch
+import time
+import queue
+import functools
 import argparse
+import threading
+
+import torch
 import numpy as np
 from chronos import ChronosPipeline
 
+MODEL_ID = "amazon/chronos-t5-small"
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+COMPILE_DECODER = DEVICE == "cuda" and hasattr(torch, 'compile')
+
+# With a compiled decoder, horizons are rounded up to one of these so it sees few distinct shapes
+PREDICTION_LENGTHS = (5, 10, 20, 30, 64)
+
+# Server mode coalesces requests that arrive within MAX_WAIT_MS into one batch of up to MAX_BATCH
+MAX_BATCH = 16
+MAX_WAIT_MS = 5
+
+# A whole batch decodes to its longest horizon, so server requests are capped at the model's native length
+MAX_STEPS = 64
+
+# chronos-t5 context length; the tokenizer keeps only the most recent points of longer histories
+MAX_CONTEXT = 512
+
+@functools.lru_cache(maxsize=1)
+def load_pipeline():
+    pipeline = ChronosPipeline.from_pretrained(
+        MODEL_ID,
+        device_map=DEVICE,
+        torch_dtype=torch.bfloat16 if DEVICE == "cuda" else torch.float32,
+    )
+
+    # Compile the T5 forward that generate() calls once per decoding step
+    if COMPILE_DECODER:
+        t5 = pipeline.model.model
+        t5.forward = torch.compile(t5.forward, mode="reduce-overhead")
+
+    return pipeline
+
+def bucket_steps(steps):
+    # Without compilation, rounding up would only add decoding steps
+    if not COMPILE_DECODER:
+        return steps
+    return next((n for n in PREDICTION_LENGTHS if n >= steps), steps)
+
+def parse_prices(raw):
+    # One C-level conversion; unlike np.fromstring this raises on malformed entries
+    if isinstance(raw, str):
+        raw = raw.split(',')
+    prices = np.asarray(raw, dtype=np.float32)
+    if prices.ndim != 1 or prices.size == 0:
+        raise ValueError("Invalid price format")
+    return prices
+
+@functools.lru_cache(maxsize=1)
+def staging_buffer():
+    return torch.empty(MAX_BATCH, MAX_CONTEXT)
+
+def stage_contexts(contexts):
+    """Left-pad contexts with NaN into the reused staging buffer and return the (batch, width) view."""
+    if len(contexts) > MAX_BATCH:
+        return [torch.from_numpy(prices) for prices in contexts]
+
+    width = min(max(len(prices) for prices in contexts), MAX_CONTEXT)
+    batch = staging_buffer()[:len(contexts), MAX_CONTEXT - width:]
+    batch.fill_(float('nan'))
+    for row, prices in zip(batch, contexts):
+        recent = prices[-width:]
+        row[width - len(recent):] = torch.from_numpy(recent)
+    return batch
+
+def handle_batch(requests, num_samples=10, temperature=None):
+    """Forecast a list of (prices, steps) requests with a single pipeline.predict call.
+
+    With num_samples=1 only the sampled path is returned as the prediction, without bounds.
+    """
+    contexts = stage_contexts([prices for prices, _ in requests])
+    max_steps = bucket_steps(max(steps for _, steps in requests))
+
+    with torch.inference_mode(), torch.autocast(device_type=DEVICE, dtype=torch.bfloat16, enabled=DEVICE == "cuda"):
+        forecast = load_pipeline().predict(
+            contexts,
+            prediction_length=max_steps,
+            num_samples=num_samples,
+            temperature=temperature,
+        )
+
+    # pipeline.predict returns float32 samples on the CPU
+    if num_samples == 1:
+        paths = forecast[:, 0].tolist()
+        return [{"prediction": paths[i][:steps]} for i, (_, steps) in enumerate(requests)]
+
+    # Quantiles over the sample dimension for the whole batch: (3, batch, max_steps),
+    # converted to lists in one go
+    quantiles = torch.tensor([0.1, 0.5, 0.9])
+    low, median, high = torch.quantile(forecast, quantiles, dim=1).tolist()
+
+    results = []
+    for i, (_, steps) in enumerate(requests):
+        results.append({
+            "prediction": median[i][:steps],
+            "lower_bound": low[i][:steps],
+            "upper_bound": high[i][:steps]
+        })
+    return results
+
+def handle(prices, steps=10, num_samples=10, temperature=None):
+    return handle_batch([(prices, steps)], num_samples, temperature)[0]
+
+def read_lines(lines):
+    for line in iter(sys.stdin.readline, ''):
+        if line.strip():
+            lines.put(line)
+    lines.put(None)
+
+def process_lines(batch, steps=10, num_samples=10, temperature=None):
+    """Turn a batch of raw request lines into responses, in the same order.
+
+    steps is the horizon for requests that do not give their own.
+    """
+    results = [None] * len(batch)
+    pending = []
+    default_steps = steps
+    for i, line in enumerate(batch):
+        try:
+            req = json.loads(line)
+            prices = parse_prices(req["prices"])
+            steps = int(req.get("steps", default_steps))
+        except Exception:
+            # Includes OverflowError from values like 1e400 or Infinity
+            results[i] = {"error": "Invalid request format"}
+            continue
+
+        if not 1 <= steps <= MAX_STEPS:
+            results[i] = {"error": f"steps must be between 1 and {MAX_STEPS}"}
+        else:
+            pending.append((i, prices, steps))
+
+    if pending:
+        try:
+            forecasts = handle_batch([(prices, steps) for _, prices, steps in pending], num_samples, temperature)
+        except Exception:
+            # Retry one by one so a single bad request does not fail its batch-mates
+            forecasts = []
+            for _, prices, steps in pending:
+                try:
+                    forecasts.append(handle(prices, steps, num_samples, temperature))
+                except Exception as e:
+                    forecasts.append({"error": f"Prediction failed: {str(e)}"})
+        for (i, _, _), result in zip(pending, forecasts):
+            results[i] = result
+
+    return results
+
+def serve(steps=10, num_samples=10, temperature=None):
+    """Keep the model loaded and answer one JSON request per stdin line.
+
+    Each request looks like {"prices": [...] or "1,2,3", "steps": 10}, with steps defaulting to the
+    server's; each response is one JSON line, written in request order.
+    """
+    try:
+        load_pipeline()
+        # Throwaway single-series forecast at the default horizon so the first compile happens up
+        # front; other batch sizes and horizons can still trigger recompiles on live requests
+        handle(np.zeros(60, dtype=np.float32), steps, num_samples, temperature)
+    except Exception as e:
+        print(json.dumps({"error": f"Failed to load model: {str(e)}"}))
+        sys.exit(1)
+
+    lines = queue.Queue()
+    threading.Thread(target=read_lines, args=(lines,), daemon=True).start()
+
+    eof = False
+    while not eof:
+        line = lines.get()
+        if line is None:
+            break
+
+        # Gather whatever else arrives within the wait window
+        batch = [line]
+        deadline = time.monotonic() + MAX_WAIT_MS / 1000.0
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                line = lines.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if line is None:
+                eof = True
+                break
+            batch.append(line)
+
+        # Last-resort guard: a bad batch gets error responses but never ends the worker
+        try:
+            results = process_lines(batch, steps, num_samples, temperature)
+        except Exception as e:
+            results = [{"error": f"Prediction failed: {str(e)}"}] * len(batch)
+
+        for result in results:
+            print(json.dumps(result, separators=(',', ':')))
+        sys.stdout.flush()
+
 def main():
     parser = argparse.ArgumentParser(description='Chronos Stock Prediction')
-    parser.add_argument('--prices', type=str, help='Comma separated historical prices', required=True)
+    parser.add_argument('--prices', type=str, help='Comma separated historical prices')
     parser.add_argument('--steps', type=int, default=10, help='Prediction steps')
+    parser.add_argument('--num_samples', type=int, default=10, help='Sample paths per forecast (1 returns the prediction without bounds)')
+    parser.add_argument('--temperature', type=float, default=None, help='Sampling temperature (model default if omitted)')
+    parser.add_argument('--server', action='store_true', help='Serve JSON line requests from stdin with a persistent model')
     args = parser.parse_args()
 
+    if args.num_samples < 1:
+        print(json.dumps({"error": "num_samples must be at least 1"}))
+        sys.exit(1)
+
+    if args.server:
+        if not 1 <= args.steps <= MAX_STEPS:
+            print(json.dumps({"error": f"steps must be between 1 and {MAX_STEPS}"}))
+            sys.exit(1)
+        serve(args.steps, args.num_samples, args.temperature)
+        return
+
+    if args.prices is None:
+        parser.error("--prices is required unless --server is given")
+
     # Parse prices
     try:
-        prices = [float(x) for x in args.prices.split(',')]
+        prices = parse_prices(args.prices)
     except ValueError:
         print(json.dumps({"error": "Invalid price format"}))
         sys.exit(1)
 
-    # Convert to tensor
-    context = torch.tensor([prices])
-
     # Load model
     try:
-        pipeline = ChronosPipeline.from_pretrained(
-            "amazon/chronos-t5-small",
-            device_map="cuda" if torch.cuda.is_available() else "cpu",
-            torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-        )
+        load_pipeline()
     except Exception as e:
         print(json.dumps({"error": f"Failed to load model: {str(e)}"}))
         sys.exit(1)
 
     # Predict
     try:
-        forecast = pipeline.predict(
-            context,
-            prediction_length=args.steps,
-            num_samples=20,
-        )
-        
-        # Get median prediction
-        low, median, high = torch.quantile(forecast[0], torch.tensor([0.1, 0.5, 0.9]), dim=0)
-        
-        result = {
-            "prediction": median.numpy().tolist(),
-            "lower_bound": low.numpy().tolist(),
-            "upper_bound": high.numpy().tolist()
-        }
-        
-        print(json.dumps(result))
-        
+        result = handle(prices, args.steps, args.num_samples, args.temperature)
+        print(json.dumps(result, separators=(',', ':')))
     except Exception as e:
         print(json.dumps({"error": f"Prediction failed: {str(e)}"}))
         sys.exit(1)
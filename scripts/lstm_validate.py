@@ -1,10 +1,11 @@
+import os
+import sys
+import json
+import argparse
 import torch
 import torch.nn as nn
 import numpy as np
-import argparse
-import json
-import sys
-from huggingface_hub import hf_hub_download, list_repo_files
+from huggingface_hub import hf_hub_download, list_repo_files, try_to_load_from_cache
 
 # Try to import TensorFlow/Keras for Keras model support
 try:
@@ -20,6 +21,25 @@ INPUT_SIZE = 1
 HIDDEN_SIZE = 50
 NUM_LAYERS = 2
 
+# Candidate model filenames in the Hugging Face repository, in order of preference
+PYTORCH_FILES = [
+    "model.pth",
+    "pytorch_model.bin",
+    "model.bin",
+    "lstm_model.pth",
+    "stock_lstm.pth",
+    "pytorch_model.pt",
+    "model.pt"
+]
+KERAS_FILES = [
+    "stage2_universal_lstm_20250705_170829.keras",
+    "model.keras",
+    "lstm_model.keras"
+]
+
+# Repository filenames of the last resolved model/scaler/metadata, so repeat runs skip the hub lookup
+RESOLVED_CACHE = os.path.expanduser("~/.cache/selfa/lstm_resolved.json")
+
 class StockLSTM(nn.Module):
     def __init__(self, input_size=1, hidden_size=50, num_layers=2, output_size=1):
         super(StockLSTM, self).__init__()
@@ -28,98 +48,129 @@ class StockLSTM(nn.Module):
         self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
         self.fc = nn.Linear(hidden_size, output_size)
 
-    def forward(self, x):
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        out, _ = self.lstm(x, (h0, c0))
+    def forward(self, x, state=None):
+        # state is the (h, c) pair returned by a previous call, so a sequence can be continued
+        if state is None:
+            h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
+            c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
+            state = (h0, c0)
+        out, state = self.lstm(x, state)
         out = self.fc(out[:, -1, :])
-        return out
+        return out, state
 
-def load_model(repo_id="jengyang/lstm-stock-prediction-model"):
+def cached_path(repo_id, filename):
+    """Local path of a file already in the Hugging Face cache, or None (no network access)."""
+    path = try_to_load_from_cache(repo_id=repo_id, filename=filename)
+    return path if isinstance(path, str) else None
+
+def load_resolved(repo_id):
     try:
-        # First, try to list repository files to see what's available
-        try:
-            files = list_repo_files(repo_id=repo_id)
-            print(f"Available files in repository: {files}", file=sys.stderr)
-        except:
-            pass
-        
-        # Try different possible filenames for PyTorch models
-        possible_filenames = [
-            "model.pth",
-            "pytorch_model.bin",
-            "model.bin",
-            "lstm_model.pth",
-            "stock_lstm.pth",
-            "pytorch_model.pt",
-            "model.pt"
-        ]
-        
-        model_path = None
-        scaler_path = None
-        metadata_path = None
-        last_error = None
-        
-        for filename in possible_filenames:
+        with open(RESOLVED_CACHE, 'r') as f:
+            resolved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if not isinstance(resolved, dict) or resolved.get("repo_id") != repo_id or not resolved.get("model"):
+        return None
+    
+    # Any recorded file that is no longer in the local cache makes this a miss
+    paths = []
+    for key in ("model", "scaler", "metadata"):
+        filename = resolved.get(key)
+        path = cached_path(repo_id, filename) if filename else None
+        if filename and path is None:
+            return None
+        paths.append(path)
+    return paths
+
+def save_resolved(repo_id, model_file, scaler_file, metadata_file):
+    try:
+        os.makedirs(os.path.dirname(RESOLVED_CACHE), exist_ok=True)
+        with open(RESOLVED_CACHE, 'w') as f:
+            json.dump({"repo_id": repo_id, "model": model_file, "scaler": scaler_file, "metadata": metadata_file}, f)
+    except OSError:
+        pass
+
+def resolve_cached(repo_id, error):
+    """Fall back to files already in the local cache when the repository cannot be listed (e.g. offline)."""
+    model_file = next((f for f in PYTORCH_FILES + KERAS_FILES if cached_path(repo_id, f)), None)
+    if model_file is None:
+        return None, f"Model file not found. Repository may not exist or is private. Last error: {error}"
+    
+    model_path = cached_path(repo_id, model_file)
+    print(f"Repository listing failed ({error}); using cached model file: {model_file}", file=sys.stderr)
+    
+    # Scaler and metadata sit next to the model in the same cached snapshot
+    scaler_path = None
+    metadata_path = None
+    if model_file.endswith('.keras'):
+        snapshot_dir = os.path.dirname(model_path)
+        local_files = sorted(os.listdir(snapshot_dir))
+        scaler_file = next((f for f in local_files if 'scaler' in f.lower() and f.endswith('.pkl')), None)
+        metadata_file = next((f for f in local_files if 'metadata' in f.lower() and f.endswith('.json')), None)
+        if scaler_file:
+            scaler_path = os.path.join(snapshot_dir, scaler_file)
+        if metadata_file:
+            metadata_path = os.path.join(snapshot_dir, metadata_file)
+    
+    return (model_path, scaler_path, metadata_path), None
+
+def resolve_files(repo_id):
+    """Download the model (and, for Keras, scaler/metadata) files with a single repo listing."""
+    try:
+        files = list_repo_files(repo_id=repo_id)
+        print(f"Available files in repository: {files}", file=sys.stderr)
+    except Exception as e:
+        return resolve_cached(repo_id, e)
+    
+    available = set(files)
+    model_file = next((f for f in PYTORCH_FILES + KERAS_FILES if f in available), None)
+    if model_file is None:
+        # Try to find any .keras file
+        model_file = next((f for f in files if f.endswith('.keras')), None)
+    if model_file is None:
+        return None, f"Model file not found. Available files: {', '.join(files)}"
+    
+    model_path = hf_hub_download(repo_id=repo_id, filename=model_file)
+    print(f"Found model file: {model_file}", file=sys.stderr)
+    
+    # Try to find scaler and metadata files
+    scaler_file = None
+    metadata_file = None
+    scaler_path = None
+    metadata_path = None
+    complete = True
+    if model_file.endswith('.keras'):
+        scaler_file = next((f for f in files if 'scaler' in f.lower() and f.endswith('.pkl')), None)
+        metadata_file = next((f for f in files if 'metadata' in f.lower() and f.endswith('.json')), None)
+        if scaler_file:
             try:
-                model_path = hf_hub_download(repo_id=repo_id, filename=filename)
-                print(f"Found PyTorch model file: {filename}", file=sys.stderr)
-                break
+                scaler_path = hf_hub_download(repo_id=repo_id, filename=scaler_file)
+                print(f"Found scaler file: {scaler_file}", file=sys.stderr)
             except Exception as e:
-                last_error = e
-                continue
-        
-        # If no PyTorch model found, try Keras models
-        if model_path is None:
-            keras_files = [
-                "stage2_universal_lstm_20250705_170829.keras",
-                "model.keras",
-                "lstm_model.keras"
-            ]
-            
-            for filename in keras_files:
-                try:
-                    model_path = hf_hub_download(repo_id=repo_id, filename=filename)
-                    print(f"Found Keras model file: {filename}", file=sys.stderr)
-                    break
-                except Exception as e:
-                    last_error = e
-                    continue
-            
-            # Try to find any .keras file
-            if model_path is None:
-                try:
-                    files = list_repo_files(repo_id=repo_id)
-                    keras_file = next((f for f in files if f.endswith('.keras')), None)
-                    if keras_file:
-                        model_path = hf_hub_download(repo_id=repo_id, filename=keras_file)
-                        print(f"Found Keras model file: {keras_file}", file=sys.stderr)
-                except:
-                    pass
-            
-            # Try to find scaler and metadata files
-            if model_path:
-                try:
-                    files = list_repo_files(repo_id=repo_id)
-                    scaler_file = next((f for f in files if 'scaler' in f.lower() and f.endswith('.pkl')), None)
-                    metadata_file = next((f for f in files if 'metadata' in f.lower() and f.endswith('.json')), None)
-                    
-                    if scaler_file:
-                        scaler_path = hf_hub_download(repo_id=repo_id, filename=scaler_file)
-                        print(f"Found scaler file: {scaler_file}", file=sys.stderr)
-                    if metadata_file:
-                        metadata_path = hf_hub_download(repo_id=repo_id, filename=metadata_file)
-                        print(f"Found metadata file: {metadata_file}", file=sys.stderr)
-                except:
-                    pass
-            
-            if model_path is None:
-                try:
-                    files = list_repo_files(repo_id=repo_id)
-                    available_files = ", ".join(files)
-                    return None, f"Model file not found. Available files: {available_files}. Last error: {last_error}"
-                except:
-                    return None, f"Model file not found. Repository may not exist or is private. Last error: {last_error}"
+                print(f"Failed to download scaler file {scaler_file}: {e}", file=sys.stderr)
+                complete = False
+        if metadata_file:
+            try:
+                metadata_path = hf_hub_download(repo_id=repo_id, filename=metadata_file)
+                print(f"Found metadata file: {metadata_file}", file=sys.stderr)
+            except Exception as e:
+                print(f"Failed to download metadata file {metadata_file}: {e}", file=sys.stderr)
+                complete = False
+    
+    # Only remember the resolution once every listed file is available locally
+    if complete:
+        save_resolved(repo_id, model_file, scaler_file, metadata_file)
+    return (model_path, scaler_path, metadata_path), None
+
+def load_model(repo_id="jengyang/lstm-stock-prediction-model"):
+    try:
+        resolved = load_resolved(repo_id)
+        if resolved is None:
+            resolved, err = resolve_files(repo_id)
+            if err:
+                return None, err
+        model_path, scaler_path, metadata_path = resolved
 
         # Handle Keras model
         if model_path and model_path.endswith('.keras'):
@@ -160,6 +211,7 @@ def load_model(repo_id="jengyang/lstm-stock-prediction-model"):
         return None, f"Failed to access repository: {e}"
 
     # Handle PyTorch model
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model = StockLSTM(INPUT_SIZE, HIDDEN_SIZE, NUM_LAYERS)
     try:
         state_dict = torch.load(model_path, map_location=torch.device('cpu'))
@@ -173,17 +225,71 @@ def load_model(repo_id="jengyang/lstm-stock-prediction-model"):
     except Exception as e:
         return None, f"Architecture mismatch or load error: {e}"
         
+    model.to(device)
     model.eval()
+
+    # Capture the LSTM+Linear graph once and replay it for every autoregressive step
+    if torch.cuda.is_available() and hasattr(torch, 'compile'):
+        model = torch.compile(model, mode="reduce-overhead")
+
     return model, None
 
+def build_features(seq):
+    """Build the (N, 6) feature matrix [price, price_change, ma5, ma10, ma20, volume_sim].
+
+    Moving averages use a cumulative sum; entries without a full window fall back to the price.
+    """
+    n = len(seq)
+    idx = np.arange(n)
+    cs = np.concatenate(([0.0], np.cumsum(seq)))
+    price_change = np.diff(seq, prepend=seq[0])
+    
+    mas = []
+    for window in (5, 10, 20):
+        lo = np.maximum(idx - window + 1, 0)
+        ma = (cs[idx + 1] - cs[lo]) / window
+        mas.append(np.where(idx >= window - 1, ma, seq))
+    
+    volume_sim = np.ones(n)  # Simulated volume
+    return np.column_stack([seq, price_change, mas[0], mas[1], mas[2], volume_sim])
+
+def feature_stats(features):
+    """Per-column mean and std for manual z-score normalization (used when no scaler is available)."""
+    return np.mean(features, axis=0), np.std(features, axis=0) + 1e-8
+
+def make_step_fn(keras_model, input_shape):
+    """Compile the Keras forward pass once instead of going through keras_model.predict() every step.
+
+    XLA cannot compile every model, so fall back to a plain tf.function, then to an eager call.
+    A zero-tensor warm-up call triggers compilation before the forecast loop.
+    """
+    def forward(x):
+        return keras_model(x, training=False)
+    
+    try:
+        step_fn = tf.function(forward, jit_compile=True)
+        step_fn(tf.zeros(input_shape))
+        return step_fn
+    except Exception as e:
+        print(f"XLA compilation failed, running without jit_compile: {e}", file=sys.stderr)
+    
+    try:
+        step_fn = tf.function(forward)
+        step_fn(tf.zeros(input_shape))
+        return step_fn
+    except Exception as e:
+        print(f"tf.function tracing failed, running the model eagerly: {e}", file=sys.stderr)
+    return forward
+
 def predict(model, prices, steps=1):
     predictions = []
-    current_sequence = np.array(prices[-SEQUENCE_LENGTH:])
+    current_sequence = np.asarray(prices[-SEQUENCE_LENGTH:], dtype=np.float64)
     
     # Handle Keras model
     if HAS_TF and isinstance(model, tuple) and isinstance(model[0], tf.keras.Model):
         keras_model, scaler, metadata = model
         
+        
         # Check model input shape from metadata or model itself
         input_shape = keras_model.input_shape
         print(f"Keras model input shape: {input_shape}", file=sys.stderr)
@@ -192,33 +298,39 @@ def predict(model, prices, steps=1):
         # We only have prices, so we'll create synthetic features
         if len(input_shape) == 3 and input_shape[2] == 6:
             # Create 6 features from prices: [price, price_change, ma5, ma10, ma20, volume_simulated]
-            features = []
-            for i in range(len(current_sequence)):
-                price = current_sequence[i]
-                price_change = current_sequence[i] - current_sequence[i-1] if i > 0 else 0
-                ma5 = np.mean(current_sequence[max(0, i-4):i+1]) if i >= 4 else price
-                ma10 = np.mean(current_sequence[max(0, i-9):i+1]) if i >= 9 else price
-                ma20 = np.mean(current_sequence[max(0, i-19):i+1]) if i >= 19 else price
-                volume_sim = 1.0  # Simulated volume
-                features.append([price, price_change, ma5, ma10, ma20, volume_sim])
+            # Buffers have room for the whole forecast; each step's window is a view at a moving head
+            history = np.empty(SEQUENCE_LENGTH + steps)
+            history[:SEQUENCE_LENGTH] = current_sequence
+            raw_features = np.empty((SEQUENCE_LENGTH + steps, 6))
+            raw_features[:SEQUENCE_LENGTH] = build_features(current_sequence)
+            features = np.empty_like(raw_features)
             
-            features = np.array(features)
-            
-            # Apply scaler if available
-            if scaler is not None:
+            # Apply scaler if available, otherwise (or if scaler fails) normalize manually
+            use_scaler = scaler is not None
+            if not use_scaler:
+                print("No scaler found; normalizing features with statistics of the input window", file=sys.stderr)
+            if use_scaler:
                 try:
-                    features = scaler.transform(features)
+                    features[:SEQUENCE_LENGTH] = scaler.transform(raw_features[:SEQUENCE_LENGTH])
                 except:
-                    # If scaler fails, normalize manually
-                    features = (features - np.mean(features, axis=0)) / (np.std(features, axis=0) + 1e-8)
-            else:
-                # Manual normalization
-                features = (features - np.mean(features, axis=0)) / (np.std(features, axis=0) + 1e-8)
+                    use_scaler = False
+            if not use_scaler:
+                feat_mean, feat_std = feature_stats(raw_features[:SEQUENCE_LENGTH])
+                features[:SEQUENCE_LENGTH] = (raw_features[:SEQUENCE_LENGTH] - feat_mean) / feat_std
+            
+            step_fn = make_step_fn(keras_model, (1, SEQUENCE_LENGTH, 6))
             
-            input_tensor = np.expand_dims(features, axis=0)  # (1, 60, 6)
+            # Running window sums for the moving averages
+            sum5 = np.sum(current_sequence[-5:])
+            sum10 = np.sum(current_sequence[-10:])
+            sum20 = np.sum(current_sequence[-20:])
             
-            for _ in range(steps):
-                pred_norm = keras_model.predict(input_tensor, verbose=0)
+            for head in range(steps):
+                tail = head + SEQUENCE_LENGTH
+                current_sequence = history[head:tail]
+                input_tensor = features[np.newaxis, head:tail]  # (1, 60, 6)
+                
+                pred_norm = step_fn(tf.constant(input_tensor, dtype=tf.float32)).numpy()
                 pred_val = float(pred_norm[0][0])
                 
                 # Denormalize (assuming price is first feature)
@@ -228,52 +340,50 @@ def predict(model, prices, steps=1):
                 real_pred = pred_val * std_price + mean_price
                 predictions.append(real_pred)
                 
-                # Update sequence and features for next step
-                current_sequence = np.append(current_sequence[1:], real_pred)
+                # Compute only the feature row for the new price
+                sum5 += real_pred - current_sequence[-5]
+                sum10 += real_pred - current_sequence[-10]
+                sum20 += real_pred - current_sequence[-20]
+                new_row = np.array([real_pred, real_pred - current_sequence[-1], sum5 / 5, sum10 / 10, sum20 / 20, 1.0])
                 
-                # Recalculate features
-                features = []
-                for i in range(len(current_sequence)):
-                    price = current_sequence[i]
-                    price_change = current_sequence[i] - current_sequence[i-1] if i > 0 else 0
-                    ma5 = np.mean(current_sequence[max(0, i-4):i+1]) if i >= 4 else price
-                    ma10 = np.mean(current_sequence[max(0, i-9):i+1]) if i >= 9 else price
-                    ma20 = np.mean(current_sequence[max(0, i-19):i+1]) if i >= 19 else price
-                    volume_sim = 1.0
-                    features.append([price, price_change, ma5, ma10, ma20, volume_sim])
+                history[tail] = real_pred
                 
-                features = np.array(features)
-                if scaler is not None:
+                # Normalize only the new row; manual stats stay fixed at the initial window
+                if use_scaler:
+                    # Raw rows are only needed to renormalize the window if the scaler fails
+                    raw_features[tail] = new_row
                     try:
-                        features = scaler.transform(features)
+                        features[tail] = scaler.transform(new_row.reshape(1, -1))[0]
                     except:
-                        features = (features - np.mean(features, axis=0)) / (np.std(features, axis=0) + 1e-8)
+                        use_scaler = False
+                        window = slice(head + 1, tail + 1)
+                        feat_mean, feat_std = feature_stats(raw_features[window])
+                        features[window] = (raw_features[window] - feat_mean) / feat_std
                 else:
-                    features = (features - np.mean(features, axis=0)) / (np.std(features, axis=0) + 1e-8)
-                
-                input_tensor = np.expand_dims(features, axis=0)
+                    features[tail] = (new_row - feat_mean) / feat_std
         else:
             # Fallback: single feature
-            current_sequence = current_sequence.reshape(-1, 1)
             min_val = np.min(current_sequence)
             max_val = np.max(current_sequence)
             scale = max_val - min_val if max_val != min_val else 1.0
-            normalized_seq = (current_sequence - min_val) / scale
             
-            input_tensor = np.expand_dims(normalized_seq, axis=0)  # (1, 60, 1)
+            # Room for the whole forecast; each step's window is a view at a moving head
+            normalized_seq = np.empty(SEQUENCE_LENGTH + steps)
+            normalized_seq[:SEQUENCE_LENGTH] = (current_sequence - min_val) / scale
             
-            for _ in range(steps):
-                pred_norm = keras_model.predict(input_tensor, verbose=0)
+            step_fn = make_step_fn(keras_model, (1, SEQUENCE_LENGTH, 1))
+            
+            for head in range(steps):
+                input_tensor = normalized_seq[head:head + SEQUENCE_LENGTH].reshape(1, SEQUENCE_LENGTH, 1)
+                pred_norm = step_fn(tf.constant(input_tensor, dtype=tf.float32)).numpy()
                 pred_val = float(pred_norm[0][0])
                 
                 real_pred = pred_val * scale + min_val
                 predictions.append(real_pred)
                 
-                new_step_norm = np.array([[[pred_val]]])
-                input_tensor = np.concatenate([input_tensor[:, 1:, :], new_step_norm], axis=1)
+                normalized_seq[head + SEQUENCE_LENGTH] = pred_val
     else:
         # Handle PyTorch model
-        current_sequence = current_sequence.reshape(-1, 1)
         min_val = np.min(current_sequence)
         max_val = np.max(current_sequence)
         if max_val == min_val:
@@ -283,21 +393,29 @@ def predict(model, prices, steps=1):
             
         normalized_seq = (current_sequence - min_val) / scale
         
-        input_tensor = torch.FloatTensor(normalized_seq).unsqueeze(0) # (1, 60, 1)
+        device = next(model.parameters()).device
         
-        with torch.no_grad():
-            for _ in range(steps):
-                pred_norm = model(input_tensor)
-                pred_val = pred_norm.item()
-                
-                # Append to predictions (denormalized)
-                real_pred = pred_val * scale + min_val
-                predictions.append(real_pred)
-                
-                # Update sequence for next step (sliding window)
-                # Remove first, add new prediction
-                new_step_norm = torch.tensor([[[pred_val]]], dtype=torch.float32)
-                input_tensor = torch.cat((input_tensor[:, 1:, :], new_step_norm), dim=1)
+        # fp16 autocast on CUDA; bf16 is not supported by the fused LSTM cell kernel
+        with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda'):
+            # Warm-up forwards for the full-window and single-step shapes so compilation happens
+            # before the prediction loop; uncompiled models have nothing to warm up
+            if hasattr(torch, 'compile') and isinstance(model, torch._dynamo.eval_frame.OptimizedModule):
+                _, state = model(torch.zeros(1, SEQUENCE_LENGTH, 1, device=device))
+                model(torch.zeros(1, 1, 1, device=device), state)
+
+            # Run the full window once, then carry (h, c) forward and feed only the newest
+            # prediction; predictions stay on the device until one sync after the loop
+            x = torch.from_numpy(normalized_seq.astype(np.float32)).view(1, SEQUENCE_LENGTH, 1).to(device)
+            state = None
+            preds_dev = torch.empty(steps, device=device)
+            for i in range(steps):
+                pred_norm, state = model(x, state)
+                preds_dev[i] = pred_norm.squeeze()
+                x = pred_norm.view(1, 1, 1).float()
+
+        # Denormalize
+        preds_host = preds_dev.cpu().numpy()
+        predictions = (preds_host * scale + min_val).tolist()
             
     return predictions
 
@@ -308,11 +426,16 @@ def main():
     args = parser.parse_args()
 
     try:
-        prices = [float(x) for x in args.prices.split(',')]
+        # One C-level conversion; unlike np.fromstring this raises on malformed entries
+        prices = np.array(args.prices.split(','), dtype=np.float64)
     except:
         print(json.dumps({"error": "Invalid price format"}))
         sys.exit(1)
 
+    if args.steps < 0:
+        print(json.dumps({"error": "Prediction steps must not be negative"}))
+        sys.exit(1)
+
     if len(prices) < SEQUENCE_LENGTH:
         print(json.dumps({"error": f"Need at least {SEQUENCE_LENGTH} price points"}))
         sys.exit(1)
@@ -326,7 +449,7 @@ def main():
         preds = predict(model, prices, args.steps)
         print(json.dumps({
             "prediction": preds,
-            "last_price": prices[-1]
+            "last_price": float(prices[-1])
         }))
     except Exception as e:
         print(json.dumps({"error": f"Prediction error: {str(e)}"}))